@@ -1,26 +1,36 @@
 """Gcode-metadata tool for g-code files. Extracts preview pictures as well.
 """
+# pylint: disable=too-many-lines
 from time import time
 
 import base64
 import json
+import math
 import re
 import os
 import zipfile
-from typing import Dict, Any, Type, Callable, List, Optional
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+from string import digits
+from threading import Lock
+from typing import Dict, Any, Type, Callable, List, Optional, Tuple, Union
 from logging import getLogger
 from importlib.metadata import version
 
+# Optional, faster (de)serialization of cache files
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
 GCODE_EXTENSIONS = (".gcode", ".gc", ".g", ".gco")
 SLA_EXTENSIONS = ("sl1", "sl1s")
 CHARS_TO_REMOVE = ["/", "\\", "\"", "(", ")", "[", "]", "'"]
 
 log = getLogger("connect-printer")
 
-RE_ESTIMATED = re.compile(r"((?P<days>[0-9]+)d\s*)?"
-                          r"((?P<hours>[0-9]+)h\s*)?"
-                          r"((?P<minutes>[0-9]+)m\s*)?"
-                          r"((?P<seconds>[0-9]+)s)?")
+# Units of estimated time in the order they are written, with their length
+ESTIMATED_UNITS = (("d", 60 * 60 * 24), ("h", 60 * 60), ("m", 60), ("s", 1))
 
 PRINTERS = [
     'MK4IS', 'MK4MMU3', 'MK4', 'MK3SMMU3', 'MK3MMU3', 'MK3SMMU2S', 'MK3MMU2',
@@ -37,7 +47,24 @@ MATERIALS = [
     'TPU', 'NYLON'
 ]
 
-IMAGE_FORMATS = ['PNG', 'JPG']
+IMAGE_FORMATS = frozenset(('PNG', 'JPG'))
+
+# Name is everything in the filename before the first known token
+FILENAME_NAME_PAT = re.compile(r"(.*?)(?=[0-9.]+n|mm|" + "|".join(MATERIALS) +
+                               "|" + "|".join(PRINTERS) + r"|\d+[dhm]+)")
+# All the other tokens are found in a single pass, the group name is the key
+FILENAME_TOKEN_PAT = re.compile(r"(?P<nozzle>[0-9.]+)n"
+                                r"|(?P<height>[0-9.]+)mm"
+                                r"|(?P<material>" + "|".join(MATERIALS) + ")"
+                                r"|(?P<printer>" + "|".join(PRINTERS) + ")"
+                                r"|(?P<time>\d+[dhm]+(?:\d*[dhm]+)*)(?!\w)")
+
+
+# The version is the first item of a cache file, with or without indentation
+CACHE_VERSION_PAT = re.compile(
+    rb'\s*\{\s*"version"\s*:\s*"(?P<version>[^"]*)"')
+# Bytes read from the start of a cache file to find the version
+CACHE_VERSION_HEAD = 256
 
 
 class UnknownGcodeFileType(ValueError):
@@ -48,6 +75,8 @@ class UnknownGcodeFileType(ValueError):
 class ImageInfo:
     """A class to hold image info for thumbnail selection purposes"""
 
+    __slots__ = ("width", "height", "format")
+
     def __init__(self, width, height, format_):
         self.width = width
         self.height = height
@@ -71,8 +100,8 @@ class ImageInfo:
     def badness(self, target: "ImageInfo", aspect_ratio_weight=1):
         """Returns a badness score for this image compared to the target"""
         # This gives a value between 1 and infinity
-        ar_badness = (max(self.ratio, target.ratio) /
-                      min(self.ratio, target.ratio))
+        ratio, target_ratio = self.ratio, target.ratio
+        ar_badness = (max(ratio, target_ratio) / min(ratio, target_ratio))
 
         width_badness = self.dimension_badness(self.width, target.width)
         height_badness = self.dimension_badness(self.height, target.height)
@@ -115,14 +144,50 @@ def check_gcode_completion(path):
     log.debug(path)
 
 
-def from_bytes(data) -> str:
-    """Convert data in bytes to string"""
-    return str(data, 'utf-8')
+@lru_cache(maxsize=None)
+def package_version() -> str:
+    """Version of gcode-metadata, the metadata lookup is slow so it is done
+    only once"""
+    return version('py-gcode-metadata')
+
 
+def finite_numbers(value) -> bool:
+    """Checks that all floats in JSON serializable `value` are finite
 
-def to_bytes(data) -> bytes:
-    """Convert string to data in bytes"""
-    return bytes(data, 'utf-8')
+    >>> finite_numbers({"a": [1.0, 2], "b": "nan"})
+    True
+    >>> finite_numbers({"a": [1.0, float("inf")]})
+    False
+    """
+    if isinstance(value, float):
+        return math.isfinite(value)
+    if isinstance(value, dict):
+        return all(map(finite_numbers, value.values()))
+    if isinstance(value, list):
+        return all(map(finite_numbers, value))
+    return True
+
+
+def dump_json(data) -> bytes:
+    """Serialize data to compact JSON, using orjson if it is installed.
+    orjson would write NaN and infinity as null, such data are serialized
+    by json. orjson raises TypeError for integers over 64 bits, which it
+    could not read back as integers either"""
+    if orjson is not None and finite_numbers(data):
+        return orjson.dumps(data)  # pylint: disable=no-member
+    return json.dumps(data).encode()
+
+
+def load_json(data: bytes):
+    """Deserialize JSON data, using orjson if it is installed.
+    NaN and infinity written by json are read by json as well.
+    Both implementations raise json.decoder.JSONDecodeError"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)  # pylint: disable=no-member
+        except json.decoder.JSONDecodeError:
+            pass
+    return json.loads(data)
 
 
 def estimated_to_seconds(value: str):
@@ -138,25 +203,44 @@ def estimated_to_seconds(value: str):
     7322
     >>> estimated_to_seconds("2d 2h 2m 2s")
     180122
+    >>> estimated_to_seconds("1h30m unknown")
+    5400
     >>> estimated_to_seconds("bad value")
     """
-    match = RE_ESTIMATED.match(value.lower())
-    if not match:
-        return None
-    values = match.groupdict()
-    retval = int(values['days'] or 0) * 60 * 60 * 24
-    retval += int(values['hours'] or 0) * 60 * 60
-    retval += int(values['minutes'] or 0) * 60
-    retval += int(values['seconds'] or 0)
+    value = value.lower()
+    length = len(value)
+    position = 0
+    retval = 0
+    for unit, seconds in ESTIMATED_UNITS:
+        end = position
+        while end < length and "0" <= value[end] <= "9":
+            end += 1
+        # each unit is optional, try the next one from the same position
+        if end == position or end == length or value[end] != unit:
+            continue
+        retval += int(value[position:end]) * seconds
+        position = end + 1
+        while position < length and value[position].isspace():
+            position += 1
 
     return retval or None
 
 
 def same_or_nothing(value_list):
-    """Returns a value only if all the values in a list are the same"""
-    if any(x != value_list[0] for x in value_list):
+    """Returns a value only if all the values in a list are the same,
+    NaN is not the same as anything, not even itself
+
+    >>> same_or_nothing([0.4, 0.4])
+    0.4
+    >>> same_or_nothing([float("nan")])
+    Traceback (most recent call last):
+    ...
+    ValueError: The values were not the same
+    """
+    first = value_list[0]
+    if not all(value == first for value in value_list):
         raise ValueError("The values were not the same")
-    return value_list[0]
+    return first
 
 
 def extract_data(input_string):
@@ -177,29 +261,37 @@ def extract_data(input_string):
         'PLA'
         >>> extract_data("ßüäö")['printer'] is None
         True
+        >>> extract_data("x_0.2mm.gcode")['time'] is None
+        True
+        >>> extract_data("v1.2.3_0.4n.gcode")['nozzle']
+        0.4
     """
+    match = FILENAME_NAME_PAT.search(input_string)
+    data = {
+        'name': match.group() if match else None,
+        'nozzle': None,
+        'height': None,
+        'material': None,
+        'printer': None,
+        'time': None
+    }
 
-    # mat_pat = material pattern, prt_pat = printer pattern
-    patterns = [
-        (r"(.*?)(?=[0-9.]+n|mm|{mat_pat}|{prt_pat}|\d+[dhm]+)", 'name'),
-        (r"([0-9.]+)n", 'nozzle'), (r"([0-9.]+)mm", 'height'),
-        (r"(?:" + "|".join(MATERIALS) + r")", 'material'),
-        (r"(?:" + "|".join(PRINTERS) + r")", 'printer'),
-        (r"(\d+[dhm]+(?:\d*[dhm]+)*)(?!\w)", 'time')
-    ]
-
-    data = {}
-    for pattern, key in patterns:
-        pattern = pattern.format(mat_pat="|".join(MATERIALS),
-                                 prt_pat="|".join(PRINTERS))
-        match = re.search(pattern, input_string)
-        if match:
-            if key in ('nozzle', 'height'):
-                data[key] = float(match.group(1))
-            else:
-                data[key] = match.group()
+    # The first valid occurrence of each token wins
+    missing = len(data) - 1
+    for match in FILENAME_TOKEN_PAT.finditer(input_string):
+        key = match.lastgroup
+        if data[key] is not None:
+            continue
+        if key in ('nozzle', 'height'):
+            try:
+                data[key] = float(match.group(key))
+            except ValueError:  # just dots
+                continue
         else:
-            data[key] = None
+            data[key] = match.group(key)
+        missing -= 1
+        if not missing:
+            break
 
     return data
 
@@ -221,7 +313,7 @@ class MetaData:
         self.chunk_buffer = b''
         self.position = 0  # current position in chunked read
 
-    @property
+    @cached_property
     def cache_name(self):
         """Create cache name in format .<filename>.cache
 
@@ -235,9 +327,8 @@ class MetaData:
         '/.x.cache'
 
         """
-        path_ = os.path.split(self.path)
-        new_path = path_[0] + "/." + path_[1] + ".cache"
-        return new_path
+        head, tail = os.path.split(self.path)
+        return os.path.join(head or os.sep, f".{tail}.cache")
 
     def is_cache_fresh(self):
         """Checks if we can use the current cache file"""
@@ -246,8 +337,8 @@ class MetaData:
     def is_cache_recent(self):
         """Checks if the cache file is newer than the source file"""
         try:
-            file_time_created = os.path.getctime(self.path)
-            cache_time_created = os.path.getctime(self.cache_name)
+            file_time_created = os.stat(self.path).st_ctime_ns
+            cache_time_created = os.stat(self.cache_name).st_ctime_ns
         except FileNotFoundError:
             return False
 
@@ -256,49 +347,35 @@ class MetaData:
     def is_cache_correct_version(self):
         """Checks if the cache file was created with the same version
         of gcode-metadata"""
-
-        def isallowed(char):
-            """Filters out disallowed characters, used with str.filter"""
-            return char not in "\",\n} "
-
         # This expects the first item in the json file to be the
         # gcode-metadata version, with which the cache was created.
         # If it's not there, or the version is different, the cache is deleted
-        with open(self.cache_name, "r", encoding="utf-8") as file:
-            for line in file:
-                if text := "".join(filter(str.isalpha, line)):
-                    if text.startswith("version"):
-                        break
-                    return False
-            else:  # didn't reach break
-                return False
-            first_pair = line.split(",", 1)[0]
-            _, version_part = first_pair.split(":", 1)
-            file_version = "".join(filter(isallowed, version_part))
-            if file_version == version('py-gcode-metadata'):
-                return True
-
-        return False
+        with open(self.cache_name, "rb") as file:
+            match = CACHE_VERSION_PAT.match(file.read(CACHE_VERSION_HEAD))
+        if match is None:
+            return False
+        return match.group("version").decode() == package_version()
 
     def save_cache(self):
         """Take metadata from source file and save them as JSON to
         <file_name>.cache file.
-        Parse thumbnail from bytes to string format because of JSON
-        serialization requirements"""
+        Thumbnails are base64, so they are stored as ASCII strings because
+        of JSON serialization requirements"""
 
         def get_cache_data(info):
             width, height = info.width, info.height
 
             return {
                 "resolution": f"{width}x{height}",
-                "data": from_bytes(self.thumbnails[info.to_thumbnail_info()]),
+                "data": self.thumbnails[info.to_thumbnail_info()].decode(
+                    "ascii"),
                 "format": info.format
             }
 
         try:
             if self.data:
                 cache = {
-                    "version": version('py-gcode-metadata'),
+                    "version": package_version(),
                     "metadata": self.data,
                 }
 
@@ -310,16 +387,19 @@ class MetaData:
                     if icon := get_icon(self.thumbnails):
                         cache["icon"] = get_cache_data(icon)
 
-                with open(self.cache_name, "w", encoding='utf-8') as file:
-                    json.dump(cache, file, indent=2)
+                data = dump_json(cache)
+                with open(self.cache_name, "wb") as file:
+                    file.write(data)
         except PermissionError:
             log.warning("You don't have permission to save file here")
+        except TypeError:
+            log.warning("Metadata of %s can't be cached", self.path)
 
     def load_cache(self):
         """Load metadata values from <file_name>.cache file"""
         try:
-            with open(self.cache_name, "r", encoding='utf-8') as file:
-                cache_data = json.load(file)
+            with open(self.cache_name, "rb") as file:
+                cache_data = load_json(file.read())
                 preview = cache_data.get("preview")
                 icon = cache_data.get("icon")
 
@@ -327,10 +407,10 @@ class MetaData:
 
             if preview:
                 key = f"{preview['resolution']}_{preview['format']}"
-                self.thumbnails[key] = to_bytes(preview["data"])
+                self.thumbnails[key] = preview["data"].encode("ascii")
             if icon:
                 key = f"{icon['resolution']}_{icon['format']}"
-                self.thumbnails[key] = to_bytes(icon["data"])
+                self.thumbnails[key] = icon["data"].encode("ascii")
 
             self.data = cache_data["metadata"]
         except (json.decoder.JSONDecodeError, FileNotFoundError, KeyError)\
@@ -341,23 +421,23 @@ class MetaData:
     def load(self, save_cache=True):
         """Extract and set metadata from `self.path`. Any metadata
         obtained from the path will be overwritten by metadata from
-        the file if the metadata is contained there as well"""
-        cache_loaded = False
+        the file if the metadata is contained there as well.
+        Returns False if loading failed, True otherwise"""
         if self.is_cache_fresh():
             try:
                 self.load_cache()
-                cache_loaded = True
+                return True
             except Exception:  # pylint: disable=broad-except
                 log.warning("Failed loading cache for: %s", self.path)
-        if not cache_loaded:
-            try:
-                self.load_from_path(self.path)
-                self.load_from_file(self.path)
-            except Exception:  # pylint: disable=broad-except
-                log.exception("Failed loading metadata from: %s", self.path)
-            else:
-                if save_cache:
-                    self.save_cache()
+        try:
+            self.load_from_path(self.path)
+            self.load_from_file(self.path)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Failed loading metadata from: %s", self.path)
+            return False
+        if save_cache:
+            self.save_cache()
+        return True
 
     def load_from_file(self, path: str):
         """Load metadata and thumbnails from given `path`"""
@@ -390,9 +470,9 @@ class MetaData:
 
     def set_attr(self, name, value):
         """A helper function that saves attributes to `self.data`"""
-        if name not in self.Attrs:
+        conv = self.Attrs.get(name)
+        if conv is None:
             return
-        conv = self.Attrs[name]
         try:
             self.data[name] = conv(value)
         except ValueError:
@@ -414,6 +494,8 @@ class MMUAttribute:
 
     # pylint: disable=too-few-public-methods
 
+    __slots__ = ("separator", "value_type", "conversion")
+
     def __init__(self,
                  separator: str = ", ",
                  value_type: Type = float,
@@ -425,12 +507,17 @@ class MMUAttribute:
     def from_string(self, raw_value):
         """Parses the value from string, returns the list value as well as a
         value for a single tool info compatibility"""
-        parsed = []
-        for value in raw_value.split(self.separator):
-            try:
-                parsed.append(self.value_type(value))
-            except ValueError:
-                return None, None
+        value_type = self.value_type
+        try:
+            if self.separator not in raw_value:  # single tool, no split
+                parsed = [value_type(raw_value)]
+            else:
+                parsed = [
+                    value_type(value)
+                    for value in raw_value.split(self.separator)
+                ]
+        except ValueError:
+            return None, None
         try:
             single_value = self.conversion(parsed)
         except ValueError:
@@ -447,8 +534,9 @@ class FDMMetaData(MetaData):
         """Set an attribute, but add support for mmu list attributes"""
         if value == '""':  # e.g. when no extruder_colour
             return
-        if name in self.MMUAttrs:
-            value_list, single_value = self.MMUAttrs[name].from_string(value)
+        mmu_attribute = self.MMUAttrs.get(name)
+        if mmu_attribute is not None:
+            value_list, single_value = mmu_attribute.from_string(value)
             mmu_name = get_mmu_name(name)
             if value_list is not None:
                 super().set_attr(mmu_name, value_list)
@@ -525,24 +613,40 @@ class FDMMetaData(MetaData):
         mmu_name = get_mmu_name(name)
         Attrs[name] = mmu_attribute.value_type
         Attrs[mmu_name] = list
-
-    KEY_VAL_PAT = re.compile("; (?P<key>.*?) = (?P<value>.*)$")
-
-    THUMBNAIL_BEGIN_PAT = re.compile(
-        r"; thumbnail_?(?P<format>QOI|JPG|) begin (?P<dim>[\w ]+) "
-        r"(?P<size>\d+)")
-    THUMBNAIL_END_PAT = re.compile("; thumbnail_?(QOI|JPG)? end")
-
-    M73_PAT = re.compile(r"^[^;]*M73 ?"
-                         r"(?:Q(?P<quiet_percent>\d+))? ?"
-                         r"(?:S(?P<quiet_left>\d+))? ?"
-                         r"(?:C(?P<quiet_change_in>\d+))? ?"
-                         r"(?:P(?P<normal_percent>\d+))? ?"
-                         r"(?:R(?P<normal_left>\d+))? ?"
-                         r"(?:D(?P<normal_change_in>\d+))? ?.*"
-                         r"$")
-
-    LAYER_CHANGE_PAT = re.compile(r"^;Z:\d+\.\d+$")
+    # do not leak the loop variables as class attributes
+    # pylint: disable=undefined-loop-variable
+    del name, mmu_name, mmu_attribute
+
+    # Comment lines starting with "; thumbnail" are matched by a single
+    # pattern, the last matched group tells which alternative it was:
+    # "size" thumbnail begin, "end" thumbnail end and "value" key = value
+    # pair (e.g. thumbnails_format). The bound match method saves the
+    # attribute lookup.
+    COMMENT_PAT = re.compile(
+        rb"; (?:"
+        rb"thumbnail_?(?P<format>QOI|JPG|) begin (?P<dim>[\w ]+) "
+        rb"(?P<size>\d+)"
+        rb"|thumbnail_?(?:QOI|JPG)? (?P<end>end)"
+        rb"|(?P<key>.*?) = (?P<value>.*)$)")
+    COMMENT_MATCH = COMMENT_PAT.match
+
+    M73_PAT = re.compile(rb"^[^;]*M73 ?"
+                         rb"(?:Q(?P<quiet_percent>\d+))? ?"
+                         rb"(?:S(?P<quiet_left>\d+))? ?"
+                         rb"(?:C(?P<quiet_change_in>\d+))? ?"
+                         rb"(?:P(?P<normal_percent>\d+))? ?"
+                         rb"(?:R(?P<normal_left>\d+))? ?"
+                         rb"(?:D(?P<normal_change_in>\d+))? ?.*"
+                         rb"$")
+    M73_MATCH = M73_PAT.match
+
+    # Lines worth processing, comments and gcode lines containing M73.
+    # Finding them in a block skips all the moves in between in C.
+    LINE_PAT = re.compile(rb"^(?:;|[^;\n]*M73).*$", re.MULTILINE)
+    LINE_FINDITER = LINE_PAT.finditer
+    # Once the M73 search is over, only the comments are worth it
+    COMMENT_LINE_PAT = re.compile(rb"^;.*$", re.MULTILINE)
+    COMMENT_LINE_FINDITER = COMMENT_LINE_PAT.finditer
 
     # M73 info group and attribute names
     M73_ATTRS = {
@@ -574,6 +678,10 @@ class FDMMetaData(MetaData):
         self.img = None
 
         self.m73_searched_bytes = 0
+        # Count of M73 attributes found, saves percent_of_m73_data calls
+        self.m73_attrs_found = 0
+        # One layer change is enough to know the file contains layer info
+        self.layer_info_found = False
 
     def load_from_path(self, path):
         """Try to obtain any usable metadata from the path itself"""
@@ -592,53 +700,64 @@ class FDMMetaData(MetaData):
         self.set_data(result)
 
     def from_comment_line(self, line):
-        """Parses data from a line in the comments"""
+        """Parses data from a bytes line in the comments, only the matched
+        values are decoded"""
+        # Layer change ;Z:<float> is the most common comment, it has no
+        # space after the semicolon, so it can't match the comment pattern
+        if line.startswith(b";Z:"):
+            if not self.layer_info_found:
+                whole, dot, fraction = line[3:].partition(b".")
+                if dot and whole.isdigit() and fraction.isdigit():
+                    self.set_attr("layer_info_present", True)
+                    self.layer_info_found = True
+            return
+
+        # Only lines starting with "; thumbnail" need the comment pattern,
+        # the bulk of "; key = value" metadata is just split
+        if not line.startswith(b"; thumbnail"):
+            if line.startswith(b"; "):
+                key, separator, value = line[2:].partition(b" = ")
+                if separator:
+                    self.set_attr(key.decode("UTF-8"), value.decode("UTF-8"))
+            return
+
+        match = self.COMMENT_MATCH(line)
+        matched = match.lastgroup if match else None
+
         # thumbnail handling
-        match = self.THUMBNAIL_BEGIN_PAT.match(line)
-        if match:
-            img_format = match.group("format")
+        if matched == "size":
+            img_format = match.group("format").decode()
 
             # PNG is not explicitly described in thumbnails header
             self.img_format = "PNG" if img_format == "" else img_format
-            self.img_dimensions = match.group("dim")
+            self.img_dimensions = match.group("dim").decode()
             self.img_size = int(match.group("size"))
-            self.img = []
+            self.img = bytearray()
             return
 
-        match = self.THUMBNAIL_END_PAT.match(line)
-        if match:
-            img_data = "".join(self.img)
+        if matched == "end":
+            if self.img is None:  # the thumbnail begin was skipped
+                return
             key = f"{self.img_dimensions}_{self.img_format}"
-            self.thumbnails[key] = img_data.encode()
-            assert len(img_data) == self.img_size, len(img_data)
-
-            self.img_format = None
-            self.img_dimensions = None
-            self.img_size = None
-            self.img = None
+            self.thumbnails[key] = bytes(self.img)
+            assert len(self.img) == self.img_size, len(self.img)
+            self.skip_thumbnail()
             return
 
-        # We store the image data only during parsing. If actively parsing:
-        if self.img is not None:
-            self.img.append(line[2:].strip())
-
         # For the bulk of metadata comments
-        match = self.KEY_VAL_PAT.match(line)
-        if match:
-            key, val = match.groups()
-            self.set_attr(key, val)
-
-        match = self.LAYER_CHANGE_PAT.match(line)
-        if match:
-            self.set_attr("layer_info_present", True)
+        if matched == "value":
+            self.set_attr(match.group("key").decode("UTF-8"),
+                          match.group("value").decode("UTF-8"))
 
     def from_gcode_line(self, line):
-        """Parses data from a line in the gcode section"""
-        match = self.M73_PAT.match(line)
+        """Parses data from a bytes line in the gcode section"""
+        match = self.M73_MATCH(line)
         if match:
             for group_name, attribute_name in self.M73_ATTRS.items():
-                if match.group(group_name) is not None:
+                if match.group(group_name) is not None \
+                        and attribute_name not in self.data:
                     self.set_attr(attribute_name, True)
+                    self.m73_attrs_found += 1
 
     def load_from_file(self, path):
         """Load metadata from file
@@ -697,13 +816,22 @@ class FDMMetaData(MetaData):
     def process_line(self, line: bytes):
         """Try to read info from given byteaaray line"""
         if line.startswith(b";"):
-            self.from_comment_line(line.decode("UTF-8"))
-        else:
-            if self.percent_of_m73_data() == 100:
+            # Don't run the comment pattern on each thumbnail body line.
+            # Base64 has no spaces, so metadata lines after an unterminated
+            # thumbnail still get parsed
+            if self.img is not None and b" = " not in line \
+                    and not line.startswith((b"; thumbnail", b";Z:")):
+                self.img += line[2:].strip()
+                return
+            if self.layer_info_found and line.startswith(b";Z:"):
                 return
-            if self.m73_searched_bytes > self.MAX_M73_SEARCH_BYTES:
+            self.from_comment_line(line)
+        else:
+            if self.m73_search_done():
                 return
-            self.from_gcode_line(line.decode("UTF-8"))
+            # Most of the gcode lines are moves, skip them quickly
+            if b"M73" in line:
+                self.from_gcode_line(line)
             self.m73_searched_bytes += len(line)
 
     def metadata_area(self, position: int, size: int) -> bool:
@@ -716,17 +844,52 @@ class FDMMetaData(MetaData):
 
     def quick_parse(self, file_descriptor):
         """Parse metadata on the start and end of the file"""
+        size = os.fstat(file_descriptor.fileno()).st_size
+        head = file_descriptor.read(self.METADATA_START_OFFSET)
+        # The start area includes the rest of the line which was cut
+        # at the area boundary
+        if not head.endswith(b"\n"):
+            head += file_descriptor.readline()
+        self.process_block(head)
+
+        # Skip the middle part of the file, unless the areas overlap
+        tail_start = size - self.METADATA_END_OFFSET
+        if tail_start > len(head):
+            self.skip_thumbnail()
+            file_descriptor.seek(tail_start)
+        self.process_block(file_descriptor.read())
+
+    def process_block(self, block: Union[bytes, memoryview]):
+        """Process all interesting lines from given block of data"""
         position = 0
-        size = file_descriptor.seek(0, os.SEEK_END)
-        file_descriptor.seek(0)
-        while position != size:
-            if not self.metadata_area(position, size):
-                # Skip the middle part of the file
-                position = size - self.METADATA_END_OFFSET
-                file_descriptor.seek(position)
-            line = file_descriptor.readline()
-            position += len(line)
-            self.process_line(line)
+        if not self.m73_search_done():
+            for match in self.LINE_FINDITER(block):
+                start, end = match.span()
+                # skipped lines were searched for M73 as well
+                self.m73_searched_bytes += start - position
+                position = end
+                self.process_line(match.group())
+                if self.m73_search_done():
+                    break
+            else:
+                # and so were the lines after the last interesting one
+                self.m73_searched_bytes += len(block) - position
+                return
+
+        for match in self.COMMENT_LINE_FINDITER(block, position):
+            self.process_line(match.group())
+
+    def m73_search_done(self) -> bool:
+        """All M73 attributes were found or the search limit is reached"""
+        return (self.m73_attrs_found == len(self.M73_ATTRS)
+                or self.m73_searched_bytes > self.MAX_M73_SEARCH_BYTES)
+
+    def skip_thumbnail(self):
+        """Forget the thumbnail being parsed, its end was skipped"""
+        self.img_format = None
+        self.img_dimensions = None
+        self.img_size = None
+        self.img = None
 
     def load_from_chunk(self, data: bytes, size: int):
         """Process given chunk array of data.
@@ -738,20 +901,24 @@ class FDMMetaData(MetaData):
             metadata_end_offset_position = size - self.METADATA_END_OFFSET
             # end offset not in chunk data
             if metadata_end_offset_position > self.position:
+                self.skip_thumbnail()
                 self.chunk_buffer = b''
                 return
             data = data[:metadata_end_offset_position]
-        data = self.chunk_buffer + data
-        lines = data.split(b"\n")
         # last line was cut in middle, save it to buffer to process it
         # with next chunk of data
-        if not data.endswith(b"\n"):
-            self.chunk_buffer = lines.pop()
-        else:
-            self.chunk_buffer = b''
-
-        for line in lines:
-            self.process_line(line)
+        end = data.rfind(b"\n") + 1
+        if not end:
+            self.chunk_buffer += data
+            return
+        start = 0
+        if self.chunk_buffer:
+            # finish the buffered line, the rest is processed without copying
+            start = data.find(b"\n") + 1
+            self.process_block(self.chunk_buffer + data[:start])
+        self.chunk_buffer = data[end:]
+        with memoryview(data) as view:
+            self.process_block(view[start:end])
 
     def percent_of_m73_data(self):
         """Report what percentage of M73 attributes has been found"""
@@ -785,27 +952,30 @@ class SLMetaData(MetaData):
         "fileCreationTimestamp": str,
     }
 
-    THUMBNAIL_NAME_PAT = re.compile(
-        r".*?(?P<dim>\d+x\d+)\.(?P<format>qoi|jpg|png)")
+    THUMBNAIL_FORMATS = ("qoi", "jpg", "png")
+
+    # Characters a JSON value can start with, NaN and Infinity included
+    JSON_START_CHARS = frozenset('{["-0123456789tfnNI \t')
 
     def load(self, save_cache=True):
         """Load metadata"""
         try:
-            super().load(save_cache)
+            return super().load(save_cache)
         except zipfile.BadZipFile:
             # NOTE can't import `log` from __init__.py because of
             #  circular dependencies
             print("%s is not a valid SL1 archive", self.path)
+            return False
 
     def load_from_file(self, path: str):
         """Load SL1 metadata
 
         :path: path to the file to load the metadata from
         """
-        data = self.extract_metadata(path)
-        self.set_data(data)
-
-        self.thumbnails = self.extract_thumbnails(path)
+        # The archive is opened, and its central directory read, only once
+        with zipfile.ZipFile(path, "r") as zip_file:
+            self.set_data(self.metadata_from_zip(zip_file))
+            self.thumbnails = self.thumbnails_from_zip(zip_file)
 
     @staticmethod
     def extract_metadata(path: str) -> Dict[str, str]:
@@ -815,17 +985,29 @@ class SLMetaData(MetaData):
         :returns Dictionary with metadata name as key and its
             value as value
         """
+        with zipfile.ZipFile(path, "r") as zip_file:
+            return SLMetaData.metadata_from_zip(zip_file)
+
+    @staticmethod
+    def metadata_from_zip(zip_file: zipfile.ZipFile) -> Dict[str, str]:
+        """Extract metadata from opened `zip_file`, see `extract_metadata`"""
         # pylint: disable=invalid-name
         data = {}
-        with zipfile.ZipFile(path, "r") as zip_file:
-            for fn in ("config.ini", "prusaslicer.ini"):
-                config_file = zip_file.read(fn).decode("utf-8")
-                for line in config_file.splitlines():
-                    key, value = line.split(" = ")
-                    try:
-                        data[key] = json.loads(value)
-                    except json.decoder.JSONDecodeError:
-                        data[key] = value
+        for fn in ("config.ini", "prusaslicer.ini"):
+            config_file = zip_file.read(fn).decode("utf-8")
+            for line in config_file.splitlines():
+                key, separator, value = line.partition(" = ")
+                if not separator:
+                    continue
+                # most of the values are plain strings, which can't be
+                # JSON, don't let them fail in the decoder
+                if value[:1] not in SLMetaData.JSON_START_CHARS:
+                    data[key] = value
+                    continue
+                try:
+                    data[key] = json.loads(value)
+                except json.decoder.JSONDecodeError:
+                    data[key] = value
         return data
 
     @staticmethod
@@ -836,30 +1018,100 @@ class SLMetaData(MetaData):
         :returns Dictionary with thumbnail dimensions as key and base64
             encoded image as value.
         """
-        thumbnails: Dict[str, bytes] = {}
         with zipfile.ZipFile(path, "r") as zip_file:
-            for info in zip_file.infolist():
-                if info.filename.startswith("thumbnail/"):
-                    match = SLMetaData.THUMBNAIL_NAME_PAT.match(info.filename)
-                    if match:
-                        img_format = match.group("format").upper()
-                        img_dim = match.group("dim")
-                        data = zip_file.read(info.filename)
-                        data = base64.b64encode(data)
-                        thumbnails[f"{img_dim}_{img_format}"] = data
+            return SLMetaData.thumbnails_from_zip(zip_file)
+
+    @staticmethod
+    def thumbnails_from_zip(zip_file: zipfile.ZipFile) -> Dict[str, bytes]:
+        """Extract thumbnails from opened `zip_file`, see
+        `extract_thumbnails`"""
+        thumbnails: Dict[str, bytes] = {}
+        for filename in zip_file.namelist():
+            if not filename.startswith("thumbnail/"):
+                continue
+            key = SLMetaData.thumbnail_key(filename)
+            if key:
+                thumbnails[key] = base64.b64encode(zip_file.read(filename))
         return thumbnails
 
+    @staticmethod
+    def thumbnail_key(filename: str) -> Optional[str]:
+        """Returns the thumbnail key for a thumbnail file name ending with
+        <width>x<height>.<format>, None for any other file name.
+
+        >>> SLMetaData.thumbnail_key("thumbnail/thumbnail400x400.png")
+        '400x400_PNG'
+        >>> SLMetaData.thumbnail_key("thumbnail/1x2x3.qoi")
+        '2x3_QOI'
+        >>> SLMetaData.thumbnail_key("thumbnail/thumbnail.png") is None
+        True
+        >>> SLMetaData.thumbnail_key("thumbnail/400x400.gif") is None
+        True
+        """
+        stem, _, img_format = filename.rpartition(".")
+        if img_format not in SLMetaData.THUMBNAIL_FORMATS:
+            return None
+        rest, _, height = stem.rpartition("x")
+        width = rest[len(rest.rstrip(digits)):]
+        if not width or not height or height.strip(digits):
+            return None
+        return f"{width}x{height}_{img_format.upper()}"
+
+
+META_CACHE_SIZE = 64  # how many parsed files get_metadata can keep in memory
+
+# (path, filename): ((mtime, ctime, size), metadata), least recent first
+meta_cache: "OrderedDict[Tuple[str, Optional[str]], " \
+    "Tuple[Tuple[int, int, int], MetaData]]" = OrderedDict()
+meta_cache_lock = Lock()
 
-def get_metadata(path: str, save_cache=True, filename=None):
+
+def get_metadata(path: str, save_cache=True, filename=None,
+                 memory_cache=False):
     """Returns the Metadata for given `path`
 
     :param path: Gcode file
     :param save_cache: Boolean if cache should be saved
     :param filename: Filename in case of temp file as the path do differs from
     the name of temp file and the meta class is decided based on extension.
+    :param memory_cache: Keep metadata of the last META_CACHE_SIZE files in
+    memory and return them again while the file is not changed. The returned
+    object is then shared between calls and must not be modified.
     """
+    if not memory_cache:
+        metadata = get_meta_class(path, filename)
+        metadata.load(save_cache)
+        return metadata
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return get_metadata(path, save_cache, filename)
+
+    key = (path, filename)
+    signature = (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size)
+    with meta_cache_lock:
+        cached = meta_cache.get(key)
+        if cached is not None and cached[0] == signature:
+            meta_cache.move_to_end(key)
+            metadata = cached[1]
+        else:
+            metadata = None
+
+    if metadata is not None:
+        if save_cache and not metadata.is_cache_fresh():
+            metadata.save_cache()
+        return metadata
+
     metadata = get_meta_class(path, filename)
-    metadata.load(save_cache)
+    if not metadata.load(save_cache):
+        return metadata  # don't remember a failed load
+
+    with meta_cache_lock:
+        meta_cache[key] = (signature, metadata)
+        meta_cache.move_to_end(key)
+        if len(meta_cache) > META_CACHE_SIZE:
+            meta_cache.popitem(last=False)
     return metadata
 
 
@@ -876,9 +1128,9 @@ def get_meta_class(path: str, filename: Optional[str] = None):
         fnl = path.lower()
 
     meta_class: MetaData
-    if fnl.lower().endswith(GCODE_EXTENSIONS):
+    if fnl.endswith(GCODE_EXTENSIONS):
         meta_class = FDMMetaData(path)
-    elif fnl.lower().endswith(SLA_EXTENSIONS):
+    elif fnl.endswith(SLA_EXTENSIONS):
         meta_class = SLMetaData(path)
     else:
         raise UnknownGcodeFileType(path)
@@ -891,20 +1143,25 @@ def get_closest_image(thumbnails: Dict[str, bytes],
     """Get the image with the closest resolution
     and aspect ratio to the target
     The weight of aspect ratio to resolution proximity can be tweaked"""
-    valid_thumbnails: List[ImageInfo] = []
-    for thumbnail in thumbnails.keys():
-        info: ImageInfo = ImageInfo.from_thumbnail_info(thumbnail)
-        if info.format in IMAGE_FORMATS:
-            if info.width >= 50 and info.height >= 50:
-                valid_thumbnails.append(info)
+    # Nothing is closer than the exact target, its badness is zero
+    if target.to_thumbnail_info() in thumbnails \
+            and target.format in IMAGE_FORMATS \
+            and target.width >= 50 and target.height >= 50:
+        return ImageInfo(target.width, target.height, target.format)
+
+    infos = map(ImageInfo.from_thumbnail_info, thumbnails)
+    valid_thumbnails = (info for info in infos
+                        if info.format in IMAGE_FORMATS
+                        and info.width >= 50 and info.height >= 50)
 
-    if not valid_thumbnails:
-        return None
+    return min(valid_thumbnails,
+               key=lambda x: x.badness(target, aspect_ratio_weight),
+               default=None)
 
-    sorted_thumbnails: List[ImageInfo] = sorted(
-        valid_thumbnails, key=lambda x: x.badness(target, aspect_ratio_weight))
 
-    return sorted_thumbnails[0]
+# Thumbnail sizes wanted by get_preview and get_icon
+PREVIEW_TARGET = ImageInfo(640, 480, "PNG")
+ICON_TARGET = ImageInfo(100, 100, "PNG")
 
 
 def get_preview(thumbnails: Dict[str, bytes]) -> Optional[ImageInfo]:
@@ -922,10 +1179,12 @@ def get_preview(thumbnails: Dict[str, bytes]) -> Optional[ImageInfo]:
     ImageInfo("900x400_PNG")
     >>> get_preview({'500x200_PNG': b''})
     ImageInfo("500x200_PNG")
+    >>> get_preview({'800x600_PNG': b'', '640x480_PNG': b''})
+    ImageInfo("640x480_PNG")
     """
 
     return get_closest_image(thumbnails,
-                             ImageInfo(640, 480, "PNG"),
+                             PREVIEW_TARGET,
                              aspect_ratio_weight=1)
 
 
@@ -942,7 +1201,7 @@ def get_icon(thumbnails: Dict[str, bytes]) -> Optional[ImageInfo]:
     True
     """
     return get_closest_image(thumbnails,
-                             ImageInfo(100, 100, "PNG"),
+                             ICON_TARGET,
                              aspect_ratio_weight=1)
 
 
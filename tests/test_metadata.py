@@ -1,7 +1,7 @@
 """Tests for gcode-metadata tool for g-code files."""
+import hashlib
 import json
 import os
-import tempfile
 import shutil
 from importlib.metadata import version
 
@@ -10,6 +10,7 @@ import pytest
 
 from gcode_metadata import (get_metadata, UnknownGcodeFileType, MetaData,
                             get_meta_class)
+from gcode_metadata import metadata as metadata_module
 
 gcodes_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                           "gcodes")
@@ -18,22 +19,19 @@ gcodes_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
 
 
 @pytest.fixture
-def tmp_dir():
-    """Temporary directory creation fixture"""
-    # pylint: disable=consider-using-with
-    temp = tempfile.TemporaryDirectory()
-    yield temp.name
-    del temp
+def tmp_dir(tmp_path):
+    """Temporary directory creation fixture, a directory per test under the
+    pytest session temporary root, which pytest cleans up on its own"""
+    return str(tmp_path)
 
 
 def chunk_read_file(meta_class, filepath, chunk_size=None):
     """Util method which reads the file in chunk and call load_from_chunk
     on the blocks of data from given meta_class."""
     chunk_size = chunk_size or 10 * 1024  # 10 KiB test on small chunks
-    with open(filepath, 'rb') as file:
-        # find out file size
-        file_size = file.seek(0, os.SEEK_END)
-        file.seek(0)
+    # unbuffered, every chunk is read directly by a single read call
+    with open(filepath, 'rb', buffering=0) as file:
+        file_size = os.fstat(file.fileno()).st_size
         while True:
             chunk = file.read(chunk_size)
             if not chunk:
@@ -41,6 +39,12 @@ def chunk_read_file(meta_class, filepath, chunk_size=None):
             meta_class.load_from_chunk(chunk, file_size)
 
 
+def thumbnail_digest(data):
+    """Short digest of thumbnail data, checks the whole content while the
+    assertion message stays readable"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
 def give_cache_version(path, version_to_give):
     """Modifies the cache file and adds a valid version number"""
     with open(path, "r", encoding='utf-8') as cache_file:
@@ -61,7 +65,7 @@ def test_get_metadata_file_does_not_exist():
 def test_save_cache_empty_file():
     """Test save-cache() with empty file"""
     fname = os.path.join(gcodes_dir, "fdn_all_empty.gcode")
-    fn_cache = os.path.join(gcodes_dir, ".fdn_all_empty.gcode")
+    fn_cache = os.path.join(gcodes_dir, ".fdn_all_empty.gcode.cache")
     meta = get_metadata(fname)
     meta.save_cache()
     with pytest.raises(FileNotFoundError):
@@ -140,9 +144,90 @@ def test_is_cache_correct_version_match(tmp_dir):
     os.remove(temp_gcode)
 
 
-def test_get_metadata_invalid_file():
+def test_is_cache_correct_version_saved(tmp_dir):
+    """is_cache_correct_version, when cache file was saved by us"""
+    fn_gcode = os.path.join(gcodes_dir, "fdn_full_0.15mm_PETG_MK3S_2h6m.gcode")
+    temp_gcode = shutil.copy(fn_gcode, tmp_dir)
+    get_metadata(temp_gcode, save_cache=True)
+    assert MetaData(temp_gcode).is_cache_correct_version() is True
+
+
+@pytest.fixture(params=["json", "orjson"])
+def json_library(request, monkeypatch):
+    """Run the test with both the json and the orjson cache serialization"""
+    if request.param == "orjson":
+        monkeypatch.setattr(metadata_module, "orjson",
+                            pytest.importorskip("orjson"))
+    else:
+        monkeypatch.setattr(metadata_module, "orjson", None)
+    return request.param
+
+
+def test_cache_big_integer(tmp_dir, json_library):
+    """Integers over 64 bits are not cached by orjson, json caches them"""
+    fname = os.path.join(tmp_dir, "numbers.gcode")
+    with open(fname, "w", encoding='utf-8') as gcode:
+        gcode.write("; brim_width = 99999999999999999999\n")
+    expected = {"brim_width": 99999999999999999999}
+    meta = get_metadata(fname)
+    assert meta.data == expected
+    if json_library == "orjson":
+        assert not os.path.exists(meta.cache_name)
+        return
+    cached = MetaData(fname)
+    cached.load_cache()
+    assert cached.data == expected
+    assert isinstance(cached.data["brim_width"], int)
+
+
+def test_cache_infinity(tmp_dir, json_library):
+    """Infinity is cached and loaded back, not turned into null"""
+    # pylint: disable=unused-argument
+    fname = os.path.join(tmp_dir, "numbers.gcode")
+    with open(fname, "w", encoding='utf-8') as gcode:
+        gcode.write("; layer_height = inf\n")
+    expected = {"layer_height": float("inf")}
+    meta = get_metadata(fname)
+    assert meta.data == expected
+    assert os.path.exists(meta.cache_name)
+    cached = MetaData(fname)
+    cached.load_cache()
+    assert cached.data == expected
+
+
+def test_get_metadata_memory_cache(tmp_dir):
+    """get_metadata returns the parsed metadata again until the file
+    changes"""
+    fn_gcode = os.path.join(gcodes_dir, "fdn_filename.gcode")
+    temp_gcode = shutil.copy(fn_gcode, tmp_dir)
+    meta = get_metadata(temp_gcode, False, memory_cache=True)
+    assert get_metadata(temp_gcode, False, memory_cache=True) is meta
+    assert get_metadata(temp_gcode, False) is not meta
+    # the cache file is still saved when asked for
+    assert get_metadata(temp_gcode, True, memory_cache=True) is meta
+    assert meta.is_cache_fresh()
+    with open(temp_gcode, "a", encoding='utf-8') as gcode:
+        gcode.write("; layer_height = 0.3\n")
+    changed = get_metadata(temp_gcode, False, memory_cache=True)
+    assert changed is not meta
+    assert changed.data["layer_height"] == 0.3
+
+
+def test_get_metadata_memory_cache_failed_load(tmp_dir):
+    """get_metadata does not keep metadata of a file which failed to load"""
+    fname = os.path.join(tmp_dir, "broken.sl1")
+    with open(fname, "wb") as file:
+        file.write(b"not a zip archive")
+    meta = get_metadata(fname, False, memory_cache=True)
+    assert not meta.data
+    assert get_metadata(fname, False, memory_cache=True) is not meta
+
+
+def test_get_metadata_invalid_file(tmp_dir):
     """Test get_metadata() with a file that has a wrong ending"""
-    fname = tempfile.mkstemp()[1]
+    fname = os.path.join(tmp_dir, "file.txt")
+    with open(fname, "wb"):
+        pass
     with pytest.raises(UnknownGcodeFileType):
         get_metadata(fname)
 
@@ -231,7 +316,8 @@ class TestFDNMetaData:
             'quiet_left_present': True,
             'quiet_percent_present': True,
         }
-        assert len(meta.thumbnails['640x480_PNG']) == 158644
+        assert thumbnail_digest(meta.thumbnails['640x480_PNG']) == \
+            'e05b94f3319c2a94ddff01585b3c3eb3'
 
     def test_m73_and_layer_info(self):
         """Tests an updated file with additional suppported info"""
@@ -254,7 +340,8 @@ class TestFDNMetaData:
         assert meta.data['fill_density'] == '15%'
         assert meta.data['ironing'] == 0
         assert meta.data['support_material'] == 0
-        assert len(meta.thumbnails['160x120_PNG']) == 5616
+        assert thumbnail_digest(meta.thumbnails['160x120_PNG']) == \
+            '82c8206af75ad3b64273e0dee9a5a8fb'
 
     def test_only_path(self):
         """Only the filename contains metadata. There are no thumbnails."""
@@ -292,14 +379,69 @@ class TestFDNMetaData:
 
     def test_from_chunks_fake_data(self):
         """Test chunks fake file without metadata with string"""
-        data = b'*\n' * 1024 * 1024 * 200  # 400 MB file
         chunk_meta = get_meta_class('fake_file.gcode')
         chunk_size = 10 * 1024  # 10 KiB test on small chunks
-        data_size = len(data)
-        for i in range(0, data_size, chunk_size):
-            chunk_meta.load_from_chunk(data[i:i + chunk_size], data_size)
+        chunk = b'*\n' * (chunk_size // 2)
+        data_size = 1024 * 1024 * 400  # 400 MB file, made of equal chunks
+        for _ in range(data_size // chunk_size):
+            chunk_meta.load_from_chunk(chunk, data_size)
         assert not chunk_meta.data
 
+    def test_from_chunks_m73_search_limit(self, tmp_dir):
+        """M73 after MAX_M73_SEARCH_BYTES of moves is not searched for,
+        neither in chunks nor in the whole file"""
+        fname = os.path.join(tmp_dir, "moves.gcode")
+        with open(fname, "wb") as file:
+            file.write(b"; layer_height = 0.2\n")
+            file.write(b"G1 X10.123 Y20.456 E0.789\n" * 20000)
+            file.write(b"M73 P0 R10\nM73 Q0 S10\n")
+        chunk_meta = get_meta_class(fname)
+        chunk_read_file(chunk_meta, fname)
+        meta = get_metadata(fname, False)
+        assert chunk_meta.data == meta.data == {"layer_height": 0.2}
+
+    def test_unterminated_thumbnail(self, tmp_dir):
+        """Metadata after a thumbnail without its end is still parsed"""
+        fname = os.path.join(tmp_dir, "unterminated.gcode")
+        with open(fname, "wb") as file:
+            file.write(b"; thumbnail begin 16x16 100\n; AAAA\n"
+                       b"; layer_height = 0.2\n;Z:0.2\n"
+                       b"; filament_type = PLA\n")
+        chunk_meta = get_meta_class(fname)
+        chunk_read_file(chunk_meta, fname)
+        meta = get_metadata(fname, False)
+        assert chunk_meta.data == meta.data == {
+            "layer_height": 0.2,
+            "layer_info_present": True,
+            "filament_type": "PLA",
+            "filament_type per tool": ["PLA"],
+        }
+        assert not meta.thumbnails
+
+    def test_from_chunks_thumbnail_across_chunks(self, tmp_dir):
+        """A thumbnail crossing the first chunk boundary after the start
+        area is kept, when that chunk is processed"""
+        fname = os.path.join(tmp_dir, "thumbnail.gcode")
+        moves = b"G1 X1\n"
+        head = b"; layer_height = 0.2\n"
+        head += moves * ((409000 - len(head)) // len(moves))
+        thumbnail = b"; thumbnail begin 16x16 2000\n" \
+                    + (b"; " + b"A" * 80 + b"\n") * 25 \
+                    + b"; thumbnail end\n"
+        tail = b"; filament_type = PLA\n"
+        middle = moves * ((455008 - len(head + thumbnail + tail))
+                          // len(moves))
+        with open(fname, "wb") as file:
+            file.write(head + thumbnail + middle + tail)
+        chunk_meta = get_meta_class(fname)
+        chunk_read_file(chunk_meta, fname)
+        assert chunk_meta.data == {
+            "layer_height": 0.2,
+            "filament_type": "PLA",
+            "filament_type per tool": ["PLA"],
+        }
+        assert chunk_meta.thumbnails == {"16x16_PNG": b"A" * 2000}
+
     def test_from_chunks_meta_only_path(self):
         """Test chunks from file with no metadata."""
         fname = os.path.join(gcodes_dir,
@@ -323,9 +465,11 @@ class TestFDNMetaData:
         chunk_read_file(chunk_meta, fname)
         assert chunk_meta.data == {}
 
-    def test_from_chunks_invalid_file(self):
+    def test_from_chunks_invalid_file(self, tmp_dir):
         """Test reading metadata as chunks invalid file."""
-        fname = tempfile.mkstemp()[1]
+        fname = os.path.join(tmp_dir, "file.txt")
+        with open(fname, "wb"):
+            pass
         with pytest.raises(UnknownGcodeFileType):
             get_meta_class(fname)
 
@@ -353,8 +497,10 @@ class TestSLMetaData:
             'fileCreationTimestamp': '2020-09-17 at 13:53:21 UTC'
         }
 
-        assert len(meta.thumbnails["400x400_PNG"]) == 19688
-        assert len(meta.thumbnails["800x480_PNG"]) == 64524
+        assert thumbnail_digest(meta.thumbnails["400x400_PNG"]) == \
+            "8000e8fa062b1617ca2cdbd9317ddd5b"
+        assert thumbnail_digest(meta.thumbnails["800x480_PNG"]) == \
+            "bdd2280820e95260a9d824b48dc076f2"
 
     def test_sl_empty_file(self):
         """Test a file that is empty"""